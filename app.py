@@ -10,30 +10,37 @@ if sqlite3.sqlite_version_info < (3, 35, 0):
 
 import streamlit as st
 import os
+import shutil
 import tempfile
+import hashlib
 import logging
-import torch
+import multiprocessing
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 
 # --- Import our modules, including the NEW chat history manager ---
-from src.app_logging import setup_logger, get_log_file_path
+from src.app_logging import setup_logger, get_log_mark, get_log_tail, new_worker_log_queue, forward_worker_logs
 from src.config import get_openai_api_key, get_groq_api_key, load_hf_token
-from src.data_processing import partition_and_chunk
+from src.data_processing import PDF_WORKERS, partition_and_chunk_in_worker
 from src.vector_store import create_retriever
-from src.chat_logic import get_rag_chain
-from src.chat_history import get_message_history  # <-- NEW IMPORT
+from src.chat_logic import get_rag_chain, stream_answer, lookup_cached_answer, cache_answer, warm_up_llm
+from src.chat_history import get_message_history, warm_up_redis
 
-# --- 1. Setup Logger and GPU at the very beginning (NO CHANGE) ---
+# --- 1. Setup Logger at the very beginning ---
+# GPU selection happens in the PDF worker processes, the only place local models run
 logger = setup_logger()
 load_hf_token()
 
-try:
-    if torch.cuda.is_available():
-        torch.cuda.set_device(0)
-        logger.info("CUDA is available. Set default device to GPU 0.")
-    else:
-        logger.info("CUDA not available. Operations will run on CPU.")
-except Exception as e:
-    logger.error(f"Error during GPU selection: {e}")
+@st.cache_resource(show_spinner=False)
+def warm_up_connections():
+    """Opens the Groq and Redis connections in the background, once per server process."""
+    warm_up_llm()
+    warm_up_redis()
+
+warm_up_connections()
 
 # --- Streamlit Page Configuration (NO CHANGE) ---
 st.set_page_config(page_title="Chat with your PDF", layout="wide")
@@ -45,34 +52,148 @@ if "rag_chain" not in st.session_state:
     st.session_state.rag_chain = None
 if "processed_file" not in st.session_state:
     st.session_state.processed_file = None
+if "document_key" not in st.session_state:
+    st.session_state.document_key = None
 
 # --- Helper Functions ---
+TMPFS_DIR = "/dev/shm"
+LOG_POLL_INTERVAL = 0.5 # seconds between log refreshes while a PDF is processed
+CHAIN_CACHE_SIZE = 8 # processed documents kept in memory for instant reuse
+
+@st.cache_resource(show_spinner=False)
+def get_pdf_pool():
+    """
+    Worker processes for PDF partitioning, shared by all sessions.
+    'spawn' is used because forked children cannot reuse the parent's CUDA context.
+    """
+    return ProcessPoolExecutor(max_workers=PDF_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+
+def reset_pdf_pool():
+    """
+    Discards the PDF worker pool after a worker died (e.g. killed for running out of memory).
+    A broken pool rejects every new job, so the next call to get_pdf_pool() starts a fresh one.
+    """
+    logger.warning("A PDF worker process died. Starting a new worker pool.")
+    get_pdf_pool().shutdown(wait=False, cancel_futures=True)
+    get_pdf_pool.clear()
+
+def submit_pdf_job(fn, *args, **kwargs):
+    """Submits a job to the PDF worker pool, replacing the pool first if it is broken."""
+    try:
+        return get_pdf_pool().submit(fn, *args, **kwargs)
+    except BrokenProcessPool:
+        reset_pdf_pool()
+        return get_pdf_pool().submit(fn, *args, **kwargs)
+
+@st.cache_resource(show_spinner=False)
+def get_chain_cache():
+    """
+    RAG chains of already processed documents, shared by all sessions and kept
+    across page reloads. Keyed by (SHA-256 of the PDF, enhanced processing flag),
+    oldest entries evicted first. Sessions may update it concurrently, so it is
+    only accessed while holding get_chain_cache_lock().
+    An evicted chain's Chroma collection stays on disk while any session still
+    chats with it; the vector store prunes it once it is no longer used.
+    """
+    return OrderedDict()
+
+@st.cache_resource(show_spinner=False)
+def get_chain_cache_lock():
+    """Lock guarding the shared chain cache."""
+    return threading.Lock()
+
+def _write_temp_file(data, directory):
+    """Writes data to a new temporary PDF file in directory; a partially written file is removed."""
+    tmp_file = tempfile.NamedTemporaryFile(dir=directory, delete=False, suffix=".pdf")
+    try:
+        with tmp_file:
+            tmp_file.write(data)
+    except OSError:
+        os.remove(tmp_file.name)
+        raise
+    return tmp_file.name
+
+def write_temp_pdf(pdf_bytes):
+    """
+    Writes the uploaded PDF to a temporary file and returns its path.
+    Prefers the memory-backed /dev/shm (Linux tmpfs) so the upload never hits disk,
+    but falls back to the default temp dir when /dev/shm is missing or too small
+    (Docker gives containers only 64 MB by default).
+    """
+    if os.path.isdir(TMPFS_DIR) and shutil.disk_usage(TMPFS_DIR).free > len(pdf_bytes):
+        try:
+            return _write_temp_file(pdf_bytes, TMPFS_DIR)
+        except OSError as e:
+            logger.warning(f"Could not write the upload to {TMPFS_DIR} ({e}). Using the default temp dir.")
+    return _write_temp_file(pdf_bytes, None)
+
+def start_chat_session(rag_chain, file_name, document_key, use_enhanced):
+    """Makes the given chain active and resets the chat session for the new document."""
+    st.session_state.rag_chain = rag_chain
+    st.session_state.processed_file = file_name
+    # Content hash and processing mode identify the indexed chunks for the answer cache
+    st.session_state.document_key = f"{document_key}:{'enhanced' if use_enhanced else 'basic'}"
+
+    # Reset chat session for the new document
+    if "session_id" in st.session_state:
+        del st.session_state["session_id"]
+    logger.info("✅ Chat session reset for new document.")
+
 def process_pdf(uploaded_file, use_enhanced):
     """Handles the processing of the uploaded PDF file and displays logs."""
+    # Only the log lines written from here on belong to this job
+    log_mark = get_log_mark()
     try:
         openai_key = get_openai_api_key()
         
         logger.info(f"Starting new processing job for file: {uploaded_file.name}")
         
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as tmp_file:
-            tmp_file.write(uploaded_file.getvalue())
-            tmp_file_path = tmp_file.name
+        pdf_bytes = uploaded_file.getvalue()
+        document_key = hashlib.sha256(pdf_bytes).hexdigest()
+
+        # An identical PDF processed with the same settings is reused as is
+        chain_cache = get_chain_cache()
+        cache_key = (document_key, use_enhanced)
+        with get_chain_cache_lock():
+            cached_chain = chain_cache.pop(cache_key, None)
+            if cached_chain is not None:
+                chain_cache[cache_key] = cached_chain # Re-insert as most recently used
+        if cached_chain is not None:
+            logger.info("This document was already processed. Reusing its RAG chain.")
+            start_chat_session(cached_chain, uploaded_file.name, document_key, use_enhanced)
+            st.success("Your document has been processed! You can now ask questions.")
+            return
+
+        tmp_file_path = write_temp_pdf(pdf_bytes)
         
         log_container = st.expander("Processing Logs", expanded=True)
         log_placeholder = log_container.empty()
         log_placeholder.info("Starting processing...")
         
         with st.spinner("Processing PDF... See logs below for details."):
-            # This entire processing block is unchanged
-            documents = partition_and_chunk(
+            # Partition in a worker process and refresh the logs while it runs.
+            # The job gets its own log queue so only its worker's lines show up here.
+            log_queue = new_worker_log_queue()
+            future = submit_pdf_job(
+                partition_and_chunk_in_worker,
+                log_queue,
                 pdf_path=tmp_file_path,
                 use_enhanced_processing=use_enhanced,
                 openai_api_key=openai_key,
                 temp_dir=tempfile.gettempdir()
             )
+            while not future.done():
+                forward_worker_logs(log_queue)
+                log_placeholder.code(get_log_tail(log_mark), language="log")
+                time.sleep(LOG_POLL_INTERVAL)
+            forward_worker_logs(log_queue)
+            try:
+                documents = future.result()
+            except BrokenProcessPool:
+                reset_pdf_pool()
+                raise
             
-            with open(get_log_file_path(), "r") as f:
-                log_placeholder.code(f.read(), language="log")
+            log_placeholder.code(get_log_tail(log_mark), language="log")
 
             if not documents:
                 logger.error("Partitioning returned no documents. Halting process.")
@@ -82,8 +203,7 @@ def process_pdf(uploaded_file, use_enhanced):
             logger.info("Creating document retriever...")
             retriever = create_retriever(documents, openai_key)
             
-            with open(get_log_file_path(), "r") as f:
-                log_placeholder.code(f.read(), language="log")
+            log_placeholder.code(get_log_tail(log_mark), language="log")
 
             if retriever is None:
                 logger.error("Failed to create document retriever.")
@@ -91,30 +211,24 @@ def process_pdf(uploaded_file, use_enhanced):
                 return
 
             logger.info("Creating RAG chain with the LLM...")
-            st.session_state.rag_chain = get_rag_chain(retriever)
-            st.session_state.processed_file = uploaded_file.name
-            
-            # --- MODIFICATION: Reset chat session for the new document ---
-            # This replaces the old `st.session_state.messages = []`
-            if "session_id" in st.session_state:
-                del st.session_state["session_id"]
-            logger.info("✅ Chat session reset for new document.")
-            # --- END OF MODIFICATION ---
+            rag_chain = get_rag_chain(retriever)
+            with get_chain_cache_lock():
+                # Another session may have processed the same document meanwhile
+                chain_cache.pop(cache_key, None)
+                chain_cache[cache_key] = rag_chain
+                while len(chain_cache) > CHAIN_CACHE_SIZE:
+                    chain_cache.popitem(last=False)
+            start_chat_session(rag_chain, uploaded_file.name, document_key, use_enhanced)
             
             st.success("Your document has been processed! You can now ask questions.")
             
-            with open(get_log_file_path(), "r") as f:
-                log_placeholder.code(f.read(), language="log")
+            log_placeholder.code(get_log_tail(log_mark), language="log")
 
     except Exception as e:
         logger.error(f"A critical error occurred in the processing pipeline: {e}", exc_info=True)
         st.error(f"An error occurred during processing. Please check the logs for details.")
         if 'log_placeholder' in locals():
-            try:
-                with open(get_log_file_path(), "r") as f:
-                    log_placeholder.code(f.read(), language="log")
-            except FileNotFoundError:
-                log_placeholder.error("Log file not found.")
+            log_placeholder.code(get_log_tail(log_mark), language="log")
     finally:
         if 'tmp_file_path' in locals() and os.path.exists(tmp_file_path):
             os.remove(tmp_file_path)
@@ -153,6 +267,11 @@ else:
 
     # Accept new user input
     if prompt := st.chat_input("What is your question?"):
+        # Snapshot the prior turns before recording the new question. On the first
+        # turn this is empty, so the history-aware retriever skips the rephrasing
+        # LLM call and retrieves with the question directly.
+        chat_history = list(history.messages)
+
         # Add user's message to Redis and display it
         history.add_user_message(prompt)
         with st.chat_message("user"):
@@ -162,16 +281,33 @@ else:
         with st.chat_message("assistant"):
             with st.spinner("Thinking..."):
                 try:
-                    # --- THE FIX ---
-                    # 1. Call invoke with a dictionary containing the input and chat history
-                    response_dict = st.session_state.rag_chain.invoke(
-                        {"input": prompt, "chat_history": history.messages}
-                    )
-                    # 2. Extract the actual answer from the 'answer' key of the response
-                    response = response_dict["answer"]
-                    # --- END OF FIX ---
-                    
-                    st.markdown(response)
+                    # A first-turn question stands on its own, so a cached answer to the
+                    # same question about this document can be reused as is.
+                    document_key = st.session_state.document_key
+                    response = None
+                    if not chat_history:
+                        response = lookup_cached_answer(prompt, document_key)
+
+                    if response is not None:
+                        st.markdown(response)
+                    else:
+                        # Stream the chain with the input and chat history
+                        answer_parts = []
+
+                        def answer_tokens():
+                            for token in stream_answer(
+                                st.session_state.rag_chain,
+                                {"input": prompt, "chat_history": chat_history},
+                            ):
+                                answer_parts.append(token)
+                                yield token
+
+                        # Render tokens as they arrive instead of after the full generation
+                        st.write_stream(answer_tokens())
+                        response = "".join(answer_parts)
+                        if not chat_history:
+                            cache_answer(prompt, document_key, response)
+
                     # Add the AI's response to Redis
                     history.add_ai_message(response)
                 except Exception as e:
@@ -1,15 +1,61 @@
 # check_gpu.py
-import torch
-
-if torch.cuda.is_available():
-    print("CUDA is available! Here are the detected NVIDIA GPUs:")
-    num_gpus = torch.cuda.device_count()
-    print(f"Found {num_gpus} NVIDIA GPU(s).")
-    
-    for i in range(num_gpus):
-        print(f"  Device {i}: {torch.cuda.get_device_name(i)}")
-        
-    print("\nTo use the 3060, you will likely use the device index shown above.")
-else:
-    print("CUDA is not available. PyTorch cannot see your NVIDIA GPU.")
-    print("Please ensure you have installed the GPU version of PyTorch and that your NVIDIA drivers are up to date.")
\ No newline at end of file
+# Lists the NVIDIA GPUs on this machine without importing torch.
+# Uses NVML (pip install nvidia-ml-py) when available, otherwise `nvidia-smi -L`.
+# Run with --torch to check what PyTorch itself can see.
+import shutil
+import subprocess
+import sys
+
+def check_with_torch():
+    import torch
+
+    if torch.cuda.is_available():
+        print("CUDA is available! Here are the detected NVIDIA GPUs:")
+        num_gpus = torch.cuda.device_count()
+        print(f"Found {num_gpus} NVIDIA GPU(s).")
+
+        for i in range(num_gpus):
+            print(f"  Device {i}: {torch.cuda.get_device_name(i)}")
+
+        print("\nTo use the 3060, you will likely use the device index shown above.")
+    else:
+        print("CUDA is not available. PyTorch cannot see your NVIDIA GPU.")
+        print("Please ensure you have installed the GPU version of PyTorch and that your NVIDIA drivers are up to date.")
+
+def list_gpu_names():
+    """Returns the names of the NVIDIA GPUs, or None if no driver could be queried."""
+    try:
+        import pynvml
+        pynvml.nvmlInit()
+        try:
+            names = []
+            for i in range(pynvml.nvmlDeviceGetCount()):
+                name = pynvml.nvmlDeviceGetName(pynvml.nvmlDeviceGetHandleByIndex(i))
+                names.append(name.decode() if isinstance(name, bytes) else name)
+            return names
+        finally:
+            pynvml.nvmlShutdown()
+    except Exception:
+        pass
+
+    if shutil.which("nvidia-smi"):
+        result = subprocess.run(["nvidia-smi", "-L"], capture_output=True, text=True)
+        if result.returncode == 0:
+            return [line for line in result.stdout.splitlines() if line.strip()]
+    return None
+
+def check_with_driver():
+    names = list_gpu_names()
+    if names:
+        print(f"Found {len(names)} NVIDIA GPU(s).")
+        for i, name in enumerate(names):
+            print(f"  Device {i}: {name}")
+        print("\nRun with --torch to confirm that PyTorch can use them.")
+    else:
+        print("No NVIDIA GPU detected. Please ensure your NVIDIA drivers are installed and up to date.")
+
+if __name__ == "__main__":
+    if "--torch" in sys.argv[1:]:
+        check_with_torch()
+    else:
+        check_with_driver()
@@ -1,40 +1,88 @@
+import atexit
+import itertools
 import logging
+import multiprocessing
 import os
-from logging.handlers import RotatingFileHandler
+import queue
+import threading
+from collections import deque
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 
 # Define the log directory and file path
 LOG_DIR = "logs"
 LOG_FILE = os.path.join(LOG_DIR, "app.log")
 
+# Number of formatted log lines kept in memory for the Streamlit log viewer
+LOG_TAIL_LINES = 2000
+
+class _BufferHandler(logging.Handler):
+    """
+    Keeps the most recent formatted log records in memory so the UI can show
+    them without re-reading the log file from disk.
+    """
+    def __init__(self, maxlen=LOG_TAIL_LINES):
+        super().__init__()
+        self.records = deque(maxlen=maxlen)
+        # Total number of records ever appended; marks positions in the stream
+        self.count = 0
+
+    def emit(self, record):
+        try:
+            self.records.append(self.format(record))
+            self.count += 1
+        except Exception:
+            self.handleError(record)
+
+# A single buffer shared across Streamlit reruns
+_buffer_handler = _BufferHandler()
+
+# Background listener that performs the file writes
+_listener = None
+
+# In a worker process, the queue its log records are sent through
+_worker_log_queue = None
+
+# Manager process hosting the per-job worker log queues, started on first use
+_log_manager = None
+_log_manager_lock = threading.Lock()
+
 def setup_logger():
     """
     Sets up a rotating file logger for the application.
     - Creates a 'logs' directory if it doesn't exist.
-    - Clears the log file on each new run for a clean view.
+    - Clears the log file once per server process for a clean view.
     - Formats logs to be clear and informative.
+    - Mirrors records into an in-memory buffer for the UI log viewer.
+    - Writes to the file from a background thread via a queue, so logging
+      calls on the request thread never block on disk I/O.
+    Safe to call on every Streamlit rerun: after the first call it returns
+    the already-configured root logger without touching the log file.
     """
+    global _listener
+    logger = logging.getLogger()
+    if getattr(logger, "_app_configured", False):
+        return logger
+
     # Create the logs directory if it doesn't exist
     if not os.path.exists(LOG_DIR):
         os.makedirs(LOG_DIR)
 
     # Clear the log file at the start of a new session
-    # This ensures the log viewer in Streamlit only shows logs for the current run
+    # This ensures the log viewer in Streamlit only shows logs for the current server process
     if os.path.exists(LOG_FILE):
-        open(LOG_FILE, 'w').close()
-        
-    # Get the root logger
-    logger = logging.getLogger()
+        os.truncate(LOG_FILE, 0)
+
     logger.setLevel(logging.INFO) # Capture messages of level INFO and above
 
     # Prevent Streamlit from adding its own handlers, which can cause duplicate logs
     if logger.hasHandlers():
         logger.handlers.clear()
-        
+
     # Create a handler that writes log messages to a file, with rotation
     # This prevents the log file from growing indefinitely
     handler = RotatingFileHandler(
-        LOG_FILE, 
-        maxBytes=1*1024*1024, # 1 MB per file
+        LOG_FILE,
+        maxBytes=16*1024*1024, # 16 MB per file
         backupCount=5        # Keep up to 5 old log files
     )
 
@@ -44,12 +92,79 @@ def setup_logger():
         datefmt='%Y-%m-%d %H:%M:%S'
     )
     handler.setFormatter(formatter)
+    _buffer_handler.setFormatter(formatter)
 
-    # Add the handler to the root logger
-    logger.addHandler(handler)
+    # The file handler runs on the listener thread; the root logger only
+    # enqueues records. The buffer handler stays inline since it is a cheap
+    # in-memory append and the UI expects to see records immediately.
+    log_queue = queue.SimpleQueue()
+    _listener = QueueListener(log_queue, handler)
+    _listener.start()
 
+    # Add the handlers to the root logger
+    logger.addHandler(QueueHandler(log_queue))
+    logger.addHandler(_buffer_handler)
+
+    logger._app_configured = True
     return logger
 
+def _stop_listener():
+    """Flushes any queued records to the log file at interpreter exit."""
+    if _listener is not None:
+        _listener.stop()
+
+atexit.register(_stop_listener)
+
 def get_log_file_path():
     """A helper function to get the path to the log file."""
-    return LOG_FILE
\ No newline at end of file
+    return LOG_FILE
+
+def get_log_mark():
+    """Returns a marker for the current end of the log buffer, to pass to get_log_tail()."""
+    return _buffer_handler.count
+
+def get_log_tail(since=0):
+    """
+    Returns the buffered log lines recorded after the marker `since` as a single string,
+    so a processing job shows only its own run and not earlier jobs or other sessions.
+    """
+    with _buffer_handler.lock:
+        records = list(_buffer_handler.records)
+        new_count = _buffer_handler.count - since
+    return "\n".join(itertools.islice(records, max(len(records) - new_count, 0), None))
+
+def new_worker_log_queue():
+    """
+    Returns a new process-safe queue for the log records of one job's worker processes.
+    Workers attach it with configure_worker_logging(); the session that started the job
+    replays the records with forward_worker_logs(), so concurrent jobs never see each
+    other's lines. The queue lives for as long as the caller keeps a reference to it.
+    """
+    global _log_manager
+    with _log_manager_lock:
+        if _log_manager is None:
+            _log_manager = multiprocessing.Manager()
+    return _log_manager.Queue()
+
+def get_worker_log_queue():
+    """Returns the log queue this worker process was attached to by configure_worker_logging()."""
+    return _worker_log_queue
+
+def configure_worker_logging(log_queue):
+    """Routes every log record of the current (worker) process to log_queue."""
+    global _worker_log_queue
+    # Lets this worker hand the same queue on to processes it starts itself
+    _worker_log_queue = log_queue
+    logger = logging.getLogger()
+    logger.handlers.clear()
+    logger.addHandler(QueueHandler(log_queue))
+    logger.setLevel(logging.INFO)
+
+def forward_worker_logs(log_queue):
+    """Replays the log records received so far from workers through this process's handlers."""
+    while True:
+        try:
+            record = log_queue.get_nowait()
+        except queue.Empty:
+            break
+        logging.getLogger(record.name).handle(record)
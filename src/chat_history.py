@@ -1,8 +1,47 @@
 import streamlit as st
+import logging
+import threading
 import uuid
+from functools import lru_cache
+import redis
+from langchain_core.messages import AIMessage, HumanMessage
 from langchain_redis.chat_message_history import RedisChatMessageHistory
 from src.config import get_redis_url
 
+logger = logging.getLogger(__name__)
+
+# Upper bound on pooled Redis connections shared by all sessions
+REDIS_MAX_CONNECTIONS = 16
+# Seconds a command waits for a free pooled connection before failing
+REDIS_POOL_TIMEOUT = 10
+
+# session_state key holding the local copy of the current session's messages
+MESSAGES_CACHE_KEY = "_msgs_cache"
+
+@lru_cache(maxsize=1)
+def get_redis_client():
+    """
+    Returns a Redis client backed by a single connection pool for the process.
+    When all connections are busy, commands wait for one to be returned instead of failing.
+    Built lazily so a missing REDIS_URL only fails on first use, not at import.
+    """
+    pool = redis.BlockingConnectionPool.from_url(
+        get_redis_url(), max_connections=REDIS_MAX_CONNECTIONS, timeout=REDIS_POOL_TIMEOUT
+    )
+    return redis.Redis(connection_pool=pool)
+
+def _ping_redis():
+    """Opens a pooled Redis connection ahead of the first request."""
+    try:
+        get_redis_client().ping()
+        logger.info("Redis connection warmed up.")
+    except Exception as e:
+        logger.warning(f"Redis warm-up failed: {e}")
+
+def warm_up_redis():
+    """Connects to Redis in a background thread so the first chat turn finds a ready connection."""
+    threading.Thread(target=_ping_redis, name="redis-warmup", daemon=True).start()
+
 def get_session_id():
     """
     Ensures a unique session ID exists for the user's browser tab.
@@ -11,14 +50,44 @@ def get_session_id():
         st.session_state.session_id = str(uuid.uuid4())
     return st.session_state.session_id
 
+@st.cache_resource(show_spinner=False, max_entries=256)
+def _get_history_for_session(session_id):
+    """Builds the history object for a session once and reuses it on reruns."""
+    return RedisChatMessageHistory(session_id, redis_client=get_redis_client())
+
+class CachedHistory:
+    """
+    Write-through cache around a RedisChatMessageHistory.
+    Messages are loaded from Redis once per session and mirrored in
+    st.session_state, so reading them on a rerun needs no Redis round trip.
+    New messages are written to Redis and appended to the local copy.
+    """
+    def __init__(self, history, session_id):
+        self.history = history
+        cached = st.session_state.get(MESSAGES_CACHE_KEY)
+        if cached is None or cached[0] != session_id:
+            # langchain_redis stores messages as JSON documents and returns the
+            # whole session from one FT.SEARCH, so this is a single round trip
+            cached = (session_id, list(history.messages))
+            st.session_state[MESSAGES_CACHE_KEY] = cached
+        self._messages = cached[1]
+
+    @property
+    def messages(self):
+        return self._messages
+
+    def add_user_message(self, message):
+        self.history.add_user_message(message)
+        self._messages.append(HumanMessage(content=message))
+
+    def add_ai_message(self, message):
+        self.history.add_ai_message(message)
+        self._messages.append(AIMessage(content=message))
+
 def get_message_history():
     """
-    Returns a RedisChatMessageHistory object for the current session,
+    Returns the message history for the current session,
     which syncs chat messages with the Redis database.
     """
     session_id = get_session_id()
-    redis_url = get_redis_url()
-    
-    # --- THIS IS THE FIX ---
-    # Pass redis_url as the second positional argument, not a keyword argument.
-    return RedisChatMessageHistory(session_id, redis_url)
\ No newline at end of file
+    return CachedHistory(_get_history_for_session(session_id), session_id)
@@ -1,49 +1,74 @@
+import asyncio
 import logging
+import threading
+from functools import lru_cache
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
 from langchain.chains import create_history_aware_retriever, create_retrieval_chain
 from langchain.chains.combine_documents import create_stuff_documents_chain
 from langchain_groq import ChatGroq
-from src.config import get_groq_api_key
+from redisvl.extensions.llmcache import SemanticCache
+from redisvl.query.filter import Tag
+from redisvl.utils.vectorize import OpenAITextVectorizer
+from src.chat_history import get_redis_client
+from src.config import get_groq_api_key, get_openai_api_key, use_verbose_qa_prompt
 
 logger = logging.getLogger(__name__)
 
-def get_rag_chain(retriever):
-    """
-    Creates and returns a conversational RAG chain that is aware of chat history.
-    """
-    try:
-        groq_api_key = get_groq_api_key()
-        llm = ChatGroq(temperature=0, groq_api_key=groq_api_key, model_name="llama-3.3-70b-versatile")
-        logger.info("Groq LLM initialized successfully.")
-    except ValueError as e:
-        logger.error(f"Failed to initialize Groq LLM: {e}")
-        raise
+# Groq models: a large one for answers, a small fast one for question rephrasing
+ANSWER_MODEL = "llama-3.3-70b-versatile"
+REWRITE_MODEL = "llama-3.1-8b-instant"
 
-    # 1. Prompt to rephrase a follow-up question into a standalone question
-    contextualize_q_system_prompt = (
-        "Given a chat history and the latest user question "
-        "which might reference context in the chat history, "
-        "formulate a standalone question which can be understood "
-        "without the chat history. Do NOT answer the question, "
-        "just reformulate it if needed and otherwise return it as is."
-    )
-    contextualize_q_prompt = ChatPromptTemplate.from_messages(
-        [
-            ("system", contextualize_q_system_prompt),
-            MessagesPlaceholder("chat_history"),
-            ("human", "{input}"),
-        ]
-    )
-    
-    # 2. Chain to create a history-aware retriever
-    history_aware_retriever = create_history_aware_retriever(
-        llm, retriever, contextualize_q_prompt
-    )
+# Semantic answer cache: max cosine distance for a hit, and entry lifetime in seconds
+ANSWER_CACHE_DISTANCE = 0.05
+ANSWER_CACHE_TTL = 24 * 60 * 60
+# Single RediSearch index holding the cached answers of all documents
+ANSWER_CACHE_NAME = "answer_cache_by_document"
 
-    # 3. Answering Prompt (Your "Blueprint" Prompt)
-    # This is the final prompt that answers the question, using the retrieved context.
-    # It now also includes the chat history to maintain conversational flow.
-    qa_system_prompt = """
+# Prompt to rephrase a follow-up question into a standalone question
+CONTEXTUALIZE_Q_SYSTEM_PROMPT = (
+    "Given a chat history and the latest user question "
+    "which might reference context in the chat history, "
+    "formulate a standalone question which can be understood "
+    "without the chat history. Do NOT answer the question, "
+    "just reformulate it if needed and otherwise return it as is."
+)
+
+# Answering Prompt (Your "Blueprint" Prompt)
+# This is the final prompt that answers the question, using the retrieved context.
+# It now also includes the chat history to maintain conversational flow.
+# The persona/blueprint is kept free of template variables and sent as the first
+# message, so this prefix is byte-identical on every request and across users,
+# letting the provider reuse its cached prefill. The per-turn context follows it.
+QA_SYSTEM_PROMPT = """
+    ### Persona & Prime Directive
+    You are 'DocuMentor', a meticulous AI research assistant. The document in the 'CONTEXT' section is your only source of truth; ignore any prior knowledge and never speculate.
+
+    ### Core Mandates
+    1.  **Grounding:** Every fact, figure, and assertion MUST be supported by the 'CONTEXT'.
+    2.  **Information Not Found:** If the 'CONTEXT' does not contain the answer, say so clearly and directly.
+    3.  **Amnesia:** Do not use external knowledge to correct or augment the 'CONTEXT'.
+    4.  **Professionalism:** Formal, objective, precise. Full sentences, no emojis, slang, or contractions.
+
+    ### Response Blueprint
+    1.  **Definitions ("What is X?"):** A direct definition, then a "Key characteristics" bullet list.
+    2.  **Data ("How many/What value?"):** State the value directly, e.g. "The document states that the allocated budget is $5.2 million."
+    3.  **Procedures ("How do I...?"):** A numbered list with bolded action verbs.
+    4.  **Comparisons:** A markdown table, or bulleted **Advantages:**/**Disadvantages:** sections.
+    5.  **Ambiguous questions:** Do not guess. Briefly list the related topics in the document and ask which one is meant.
+    6.  **Corrections:** Re-verify against the 'CONTEXT' and report the finding, acknowledging the user if they are right.
+    7.  **Opinions:** State that you have no opinions, then give any relevant facts from the document.
+    8.  **Greetings:** Reply politely and offer help with the document.
+    9.  **Thanks:** Acknowledge and ask whether anything else needs clarifying.
+    10. **Identity:** "I am DocuMentor, an AI research assistant that answers questions based on the document you have provided."
+    11. **Off-topic requests:** Decline and restate that you only answer questions about the uploaded document.
+    12. **Frustration:** Stay neutral and explain that you only report what the document explicitly states.
+
+    ---
+    """
+
+# The original, example-heavy blueprint. Roughly five times longer than the
+# condensed prompt above; selectable through USE_VERBOSE_QA_PROMPT for comparison.
+QA_SYSTEM_PROMPT_VERBOSE = """
     ### Persona & Prime Directive
     You are 'DocuMentor', a world-class AI research assistant. Your persona is a blend of a meticulous legal archivist and a clear technical writer. Your single, unassailable purpose is to act as a perfect, factual, and precise interface to the document provided in the 'CONTEXT' section. You must treat this CONTEXT as the absolute and only source of truth. Any knowledge you had before this moment is irrelevant. Your reputation hinges on your unwavering accuracy and your disciplined refusal to speculate.
 
@@ -173,25 +198,178 @@ def get_rag_chain(retriever):
         - **Example 2 Response:** "My apologies if the answer was not what you were expecting. My response is generated directly from the information available in the provided context. Perhaps I can assist in another way?"
 
     ---
+    """
 
+QA_CONTEXT_PROMPT = """
     ---
     CONTEXT:
     {context}
     """
+
+
+@lru_cache(maxsize=1)
+def _build_shared():
+    """
+    Builds the LLMs, prompts and answering chain once per process.
+    These do not depend on the uploaded document, so every new retriever
+    reuses them (and the LLM's open connection pool to Groq).
+    Built lazily so a missing GROQ key only fails on first use, not at import.
+    """
+    try:
+        groq_api_key = get_groq_api_key()
+        llm = ChatGroq(temperature=0, groq_api_key=groq_api_key, model_name=ANSWER_MODEL, streaming=True)
+        # Rephrasing a follow-up into a standalone question is simple enough for a small model
+        rewrite_llm = ChatGroq(temperature=0, groq_api_key=groq_api_key, model_name=REWRITE_MODEL)
+        logger.info("Groq LLMs initialized successfully.")
+    except ValueError as e:
+        logger.error(f"Failed to initialize Groq LLM: {e}")
+        raise
+
+    contextualize_q_prompt = ChatPromptTemplate.from_messages(
+        [
+            ("system", CONTEXTUALIZE_Q_SYSTEM_PROMPT),
+            MessagesPlaceholder("chat_history"),
+            ("human", "{input}"),
+        ]
+    )
+
     qa_prompt = ChatPromptTemplate.from_messages(
         [
-            ("system", qa_system_prompt),
+            ("system", QA_SYSTEM_PROMPT_VERBOSE if use_verbose_qa_prompt() else QA_SYSTEM_PROMPT),
+            ("system", QA_CONTEXT_PROMPT),
             MessagesPlaceholder("chat_history"),
             ("human", "{input}"),
         ]
     )
 
-    # 4. Chain to combine documents into the final prompt
+    # Chain to combine documents into the final prompt
     question_answer_chain = create_stuff_documents_chain(llm, qa_prompt)
 
-    # 5. Create the FINAL conversational retrieval chain
-    # This is the key function that correctly pipes everything together.
+    return llm, rewrite_llm, contextualize_q_prompt, question_answer_chain
+
+def get_rag_chain(retriever):
+    """
+    Creates and returns a conversational RAG chain that is aware of chat history.
+    Only the history-aware retriever is rebuilt per document; the LLMs and
+    answering chain are shared.
+    """
+    _, rewrite_llm, contextualize_q_prompt, question_answer_chain = _build_shared()
+
+    history_aware_retriever = create_history_aware_retriever(
+        rewrite_llm, retriever, contextualize_q_prompt
+    )
     rag_chain = create_retrieval_chain(history_aware_retriever, question_answer_chain)
 
     logger.info("Conversational RAG chain created successfully.")
     return rag_chain
+
+# Event loop shared by all async LLM calls, running in a background thread
+_loop = None
+_loop_lock = threading.Lock()
+
+def get_event_loop():
+    """
+    Returns the process-wide event loop that runs every async chain call, started on first use.
+    The shared ChatGroq clients keep their async connections bound to the loop that opened
+    them, so all sessions and turns must use this one long-lived loop.
+    """
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name="llm-event-loop", daemon=True).start()
+    return _loop
+
+def run_async(coro):
+    """Runs a coroutine on the shared event loop and waits for its result."""
+    return asyncio.run_coroutine_threadsafe(coro, get_event_loop()).result()
+
+async def _next_chunk(chunks):
+    return await chunks.__anext__()
+
+def stream_answer(rag_chain, inputs):
+    """
+    Yields the answer tokens produced by the RAG chain for the given inputs.
+    The chain's async path is driven on the shared event loop, so the dense and
+    keyword retrievers inside the ensemble are queried concurrently instead of
+    one after the other.
+    """
+    chunks = rag_chain.astream(inputs)
+    try:
+        while True:
+            try:
+                chunk = run_async(_next_chunk(chunks))
+            except StopAsyncIteration:
+                break
+            token = chunk.get("answer", "")
+            if token:
+                yield token
+    finally:
+        run_async(chunks.aclose())
+
+async def _aping_llms():
+    """Sends a one-token request through each shared LLM's async client to open its connection."""
+    llm, rewrite_llm, _, _ = _build_shared()
+    await asyncio.gather(*(model.bind(max_tokens=1).ainvoke("ping") for model in (llm, rewrite_llm)))
+
+def _ping_llms():
+    """Runs the warm-up on the shared event loop; failures are only logged."""
+    try:
+        run_async(_aping_llms())
+        logger.info("Groq connections warmed up.")
+    except Exception as e:
+        logger.warning(f"Groq warm-up failed: {e}")
+
+def warm_up_llm():
+    """
+    Builds the shared LLMs and opens their HTTPS connections to Groq in a
+    background thread, so the first question does not pay for the handshake.
+    The requests go through the async clients on the shared event loop, the
+    same connections that answers and question rephrasing use.
+    """
+    threading.Thread(target=_ping_llms, name="groq-warmup", daemon=True).start()
+
+@lru_cache(maxsize=1)
+def _get_answer_cache():
+    """
+    Returns the Redis-backed semantic cache of answers, built on first use.
+    All documents share one index; every entry is tagged with its document key and
+    lookups are filtered on it, so the same question about two documents never
+    shadows or overwrites the other's answer.
+    """
+    return SemanticCache(
+        name=ANSWER_CACHE_NAME,
+        vectorizer=OpenAITextVectorizer(model="text-embedding-3-large", api_config={"api_key": get_openai_api_key()}),
+        redis_client=get_redis_client(),
+        distance_threshold=ANSWER_CACHE_DISTANCE,
+        ttl=ANSWER_CACHE_TTL,
+        filterable_fields=[{"name": "document_key", "type": "tag"}],
+    )
+
+def lookup_cached_answer(question, document_key):
+    """
+    Returns a previously generated answer to the same or a near-identical question
+    about the same document, or None. Only meaningful for standalone questions,
+    since follow-ups depend on the chat history.
+    Cache errors are logged and treated as a miss.
+    """
+    try:
+        hits = _get_answer_cache().check(
+            prompt=question,
+            num_results=1,
+            filter_expression=Tag("document_key") == document_key,
+        )
+    except Exception as e:
+        logger.warning(f"Answer cache lookup failed: {e}")
+        return None
+    if not hits:
+        return None
+    logger.info("Answer served from the semantic cache.")
+    return hits[0]["response"]
+
+def cache_answer(question, document_key, answer):
+    """Stores an answer in the semantic cache, tagged with its document."""
+    try:
+        _get_answer_cache().store(prompt=question, response=answer, filters={"document_key": document_key})
+    except Exception as e:
+        logger.warning(f"Failed to store answer in cache: {e}")
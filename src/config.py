@@ -34,4 +34,8 @@ def get_redis_url():
     if not url:
         logger.error("REDIS_URL not found in environment variables.")
         raise ValueError("REDIS_URL not found in environment variables.")
-    return url
\ No newline at end of file
+    return url
+
+def use_verbose_qa_prompt():
+    """Returns True when the original, example-heavy QA prompt should be used."""
+    return os.getenv("USE_VERBOSE_QA_PROMPT", "").lower() in ("1", "true", "yes")
@@ -1,56 +1,217 @@
-import base64
+import asyncio
+import hashlib
+import heapq
+import io
+import logging
+import multiprocessing
 import os
+import re
+import shutil
+import tempfile
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+import httpx
+import pikepdf
+import pybase64
+from PIL import Image as PILImage
 from langchain_openai import ChatOpenAI
 from langchain_core.messages import HumanMessage
 from langchain.schema import Document
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from unstructured.documents.elements import Title, Header, NarrativeText, ListItem, Text, Image, Table
 from unstructured.partition.pdf import partition_pdf
+from src.app_logging import configure_worker_logging, get_worker_log_queue
+
+logger = logging.getLogger(__name__)
 
 # --- IMAGE AND TABLE SUMMARIZATION (Requires Vision Model) ---
 
+# Maximum number of summarization requests in flight at once
+SUMMARY_CONCURRENCY = 20
+
+# An image covering at least this share of its page is treated as a page scan,
+# and not summarized when the page already yielded this much OCR text
+FULL_PAGE_AREA_RATIO = 0.9
+MIN_PAGE_TEXT_CHARS = 200
+
+# Images are downscaled to fit this many pixels on their long edge before being sent,
+# since vision input is billed per 512x512 tile of the uploaded image
+MAX_IMAGE_EDGE = 1536
+IMAGE_JPEG_QUALITY = 85
+# Images no larger than one tile lose nothing when sent at "low" detail
+LOW_DETAIL_MAX_EDGE = 512
+
 def encode_image(image_path):
-    """Encodes an image file into a base64 string."""
-    with open(image_path, "rb") as image_file:
-        return base64.b64encode(image_file.read()).decode('utf-8')
+    """
+    Encodes an image file into a base64 JPEG string for the vision model.
+    Returns (encoded_image, detail): the image is downscaled to at most MAX_IMAGE_EDGE
+    pixels on its long edge, and detail is "low" when it already fits in a single tile.
+    """
+    with PILImage.open(image_path) as img:
+        detail = "low" if max(img.size) <= LOW_DETAIL_MAX_EDGE else "auto"
+        img.thumbnail((MAX_IMAGE_EDGE, MAX_IMAGE_EDGE), PILImage.Resampling.LANCZOS)
+        buffer = io.BytesIO()
+        img.convert("RGB").save(buffer, format="JPEG", quality=IMAGE_JPEG_QUALITY, optimize=True)
+    return pybase64.b64encode(buffer.getbuffer()).decode("ascii"), detail
+
+def image_key(image_path):
+    """
+    Hash of an image file's bytes, so repeated identical images share one summary;
+    None if the file cannot be read. An exact hash is used because similar-looking
+    figures (charts or slides from one template) must keep their own summaries.
+    """
+    try:
+        with open(image_path, "rb") as image_file:
+            return hashlib.blake2b(image_file.read(), digest_size=16).hexdigest()
+    except OSError:
+        return None
 
-def summarize_image(encoded_image, openai_api_key):
-    """Generates a summary for a base64-encoded image using GPT-4-vision."""
+def table_key(table_html):
+    """Hash of a table's HTML with whitespace normalized, so repeated tables share one summary."""
+    normalized = re.sub(r"\s+", " ", table_html).strip()
+    return hashlib.blake2b(normalized.encode("utf-8"), digest_size=16).hexdigest()
+
+def is_full_page(el):
+    """Checks whether an element's bounding box covers (almost) its whole page."""
+    coordinates = el.metadata.coordinates
+    if coordinates is None or coordinates.system is None or not coordinates.points:
+        return False
+    xs = [x for x, _ in coordinates.points]
+    ys = [y for _, y in coordinates.points]
+    area = (max(xs) - min(xs)) * (max(ys) - min(ys))
+    return area >= FULL_PAGE_AREA_RATIO * coordinates.system.width * coordinates.system.height
+
+def image_chat_model(openai_api_key, http_client):
+    """The vision model used to describe images."""
+    return ChatOpenAI(model="gpt-4.1-2025-04-14", api_key=openai_api_key, max_tokens=2048, http_async_client=http_client)
+
+def table_chat_model(openai_api_key, http_client):
+    """The model used to summarize tables."""
+    return ChatOpenAI(model="gpt-4", api_key=openai_api_key, temperature=0, http_async_client=http_client)
+
+async def summarize_image(encoded_image, chat, detail="auto"):
+    """Generates a summary for a base64-encoded image using the given vision chat model."""
     prompt = [
         HumanMessage(
             content=[
                 {"type": "text", "text": "Describe the image in detail. Be specific about any text, data, or charts visible."},
-                {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{encoded_image}"}},
+                {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{encoded_image}", "detail": detail}},
             ]
         )
     ]
-    chat = ChatOpenAI(model="gpt-4.1-2025-04-14", api_key=openai_api_key, max_tokens=2048)
-    response = chat.invoke(prompt)
+    response = await chat.ainvoke(prompt)
     return response.content
 
-def summarize_table(table_html, openai_api_key):
-    """Generates a summary for an HTML table using GPT-4."""
+async def summarize_table(table_html, chat):
+    """Generates a summary for an HTML table using the given chat model."""
     prompt = f"Summarize the following table:\n\n{table_html}\n\nProvide a concise summary that captures the key information."
-    chat = ChatOpenAI(model="gpt-4", api_key=openai_api_key, temperature=0)
-    response = chat.invoke([HumanMessage(content=prompt)])
+    response = await chat.ainvoke([HumanMessage(content=prompt)])
     return response.content
 
+async def summarize_all(jobs, openai_api_key):
+    """
+    Summarizes images and tables concurrently, at most SUMMARY_CONCURRENCY at a time.
+    Each job is a (kind, payload) pair: ("image", image_path) or ("table", table_html).
+    Returns one summary per job, in order; a failed job yields its exception instead.
+    """
+    semaphore = asyncio.Semaphore(SUMMARY_CONCURRENCY)
+    # Both models share one HTTP client for the whole run, so all requests reuse its
+    # connection pool. It is closed when the run ends: its connections belong to this
+    # event loop, and langchain-openai would otherwise share a process-wide default
+    # client across the runs of this long-lived worker, each on a new loop.
+    http_client = httpx.AsyncClient()
+    image_chat = image_chat_model(openai_api_key, http_client)
+    table_chat = table_chat_model(openai_api_key, http_client)
+
+    async def run(kind, payload):
+        async with semaphore:
+            if kind == "image":
+                # Decoding, resizing and re-encoding is CPU work; keep it off the event loop
+                encoded_image, detail = await asyncio.to_thread(encode_image, payload)
+                return await summarize_image(encoded_image, image_chat, detail)
+            return await summarize_table(payload, table_chat)
+
+    try:
+        return await asyncio.gather(*(run(kind, payload) for kind, payload in jobs), return_exceptions=True)
+    finally:
+        await http_client.aclose()
+
 # --- CORE PDF PARTITIONING AND TEXT CHUNKING ---
 
+# PDFs longer than this are split into shards of this many pages and partitioned in parallel
+PARTITION_BATCH_PAGES = 50
 
+# Number of PDFs the app partitions at once, each in its own worker process
+PDF_WORKERS = 2
+# Upper bound on the shard processes all PDF workers start together;
+# each one loads the layout and table models (and a CUDA context)
+MAX_SHARD_PROCESSES = 4
 
-def partition_and_chunk(pdf_path, use_enhanced_processing=False, openai_api_key=None, temp_dir="temp_data"):
+def shard_workers():
     """
-    Partitions a PDF and intelligently chunks the content based on titles and sections.
-    This creates more contextually relevant chunks for better retrieval.
+    Number of shard processes one PDF worker may start: the CPUs this process may
+    run on, capped at MAX_SHARD_PROCESSES and shared between the PDF_WORKERS.
     """
-    if use_enhanced_processing and not openai_api_key:
-        raise ValueError("OpenAI API key is required for enhanced processing.")
+    # sched_getaffinity honours the CPU set a container is pinned to; it is Linux-only
+    if hasattr(os, "sched_getaffinity"):
+        cpus = len(os.sched_getaffinity(0))
+    else:
+        cpus = os.cpu_count() or 1
+    return max(1, min(cpus, MAX_SHARD_PROCESSES) // PDF_WORKERS)
+
+# Pages drawing at least this many rectangles and lines are assumed to hold a ruled table
+# or a vector chart, and are partitioned with hi_res like pages with embedded images
+MIN_VECTOR_OPS = 10
 
-    image_output_dir = os.path.join(temp_dir, "images")
-    os.makedirs(image_output_dir, exist_ok=True)
+def _has_image_xobject(resources, depth=0):
+    """Checks page or form resources for an image XObject, looking into nested forms."""
+    xobjects = resources.get("/XObject") if resources is not None else None
+    if xobjects is None:
+        return False
+    for _, xobject in xobjects.items():
+        subtype = xobject.get("/Subtype")
+        if subtype == pikepdf.Name.Image:
+            return True
+        if subtype == pikepdf.Name.Form and depth < 2 and _has_image_xobject(xobject.get("/Resources"), depth + 1):
+            return True
+    return False
 
-    raw_pdf_elements = partition_pdf(
+def page_needs_hi_res(page):
+    """
+    Cheap check of a page's PDF objects for content that only hi_res layout detection
+    extracts: an embedded image (which includes scanned pages), or enough drawn
+    rectangles and lines to be a table or chart. Pages that cannot be parsed count as visual.
+    """
+    try:
+        if _has_image_xobject(page.obj.get("/Resources")):
+            return True
+        return len(pikepdf.parse_content_stream(page, "re l")) >= MIN_VECTOR_OPS
+    except Exception:
+        return True
+
+def pages_needing_hi_res(pdf_path):
+    """Returns the 1-based numbers of the pages that need hi_res partitioning, and the page count."""
+    with pikepdf.Pdf.open(pdf_path) as pdf:
+        pages = [n for n, page in enumerate(pdf.pages, start=1) if page_needs_hi_res(page)]
+        return pages, len(pdf.pages)
+
+def element_page_number(el):
+    """The element's 1-based page number; elements without one are treated as on the first page."""
+    return el.metadata.page_number or 1
+
+def partition_fast(pdf_path, skip_pages=frozenset()):
+    """Partitions a PDF from its text layer with the fast strategy, leaving out elements on skip_pages."""
+    elements = partition_pdf(filename=pdf_path, strategy="fast")
+    return [el for el in elements if element_page_number(el) not in skip_pages]
+
+def partition_pages(pdf_path, image_output_dir, page_numbers=None):
+    """
+    Runs hi_res partitioning on a PDF. When page_numbers is given, the PDF holds
+    those pages of the original document, in order, and the returned elements
+    are renumbered to their original page numbers.
+    """
+    elements = partition_pdf(
         filename=pdf_path,
         strategy="hi_res", 
         extract_image_block_types=["Image", "Table"],
@@ -59,51 +220,250 @@ def partition_and_chunk(pdf_path, use_enhanced_processing=False, openai_api_key=
         extract_image_block_output_dir=image_output_dir,
         infer_table_structure=True,
     )
+    if page_numbers is not None:
+        for el in elements:
+            if el.metadata.page_number:
+                el.metadata.page_number = page_numbers[el.metadata.page_number - 1]
+    return elements
 
+def split_pdf(pdf_path, shard_dir, page_numbers, batch_pages=PARTITION_BATCH_PAGES):
+    """
+    Copies the given 1-based pages of a PDF into consecutive shards of at most batch_pages pages.
+    Returns a list of (shard_path, shard_page_numbers) pairs in page order.
+    """
+    shards = []
+    with pikepdf.Pdf.open(pdf_path) as pdf:
+        for start in range(0, len(page_numbers), batch_pages):
+            shard_pages = page_numbers[start:start + batch_pages]
+            shard = pikepdf.Pdf.new()
+            shard.pages.extend([pdf.pages[n - 1] for n in shard_pages])
+            shard_path = os.path.join(shard_dir, f"shard_{start // batch_pages:04d}.pdf")
+            shard.save(shard_path)
+            shards.append((shard_path, shard_pages))
+    return shards
+
+def iter_hi_res_elements(pdf_path, page_numbers, num_pages, image_output_dir, temp_dir):
+    """
+    Partitions the given pages of a PDF with hi_res and yields their elements in page order.
+    More than PARTITION_BATCH_PAGES pages are split into shards that are processed
+    by a pool of worker processes. Each shard's elements are released as soon as
+    they have been consumed, so the whole document's elements are never held in
+    memory at once.
+    """
+    if len(page_numbers) == num_pages and num_pages <= PARTITION_BATCH_PAGES:
+        yield from partition_pages(pdf_path, image_output_dir)
+        return
+
+    shard_dir = tempfile.mkdtemp(prefix="shards_", dir=temp_dir)
+    try:
+        shards = split_pdf(pdf_path, shard_dir, page_numbers)
+        if len(shards) == 1:
+            shard_path, shard_pages = shards[0]
+            yield from partition_pages(shard_path, image_output_dir, shard_pages)
+            return
+
+        logger.info(f"Partitioning {len(page_numbers)} pages as {len(shards)} shards in parallel...")
+        # 'spawn' keeps the children independent of any CUDA context in this process;
+        # they send their logs through the same queue as this worker
+        with ProcessPoolExecutor(
+            max_workers=min(len(shards), shard_workers()),
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=init_shard_worker,
+            initargs=(get_worker_log_queue(),),
+        ) as pool:
+            futures = [
+                # Each shard gets its own image directory, since extracted image
+                # file names are derived from shard-local page numbers
+                pool.submit(partition_pages, shard_path, os.path.join(image_output_dir, f"shard_{n:04d}"), shard_pages)
+                for n, (shard_path, shard_pages) in enumerate(shards)
+            ]
+            while futures:
+                yield from futures.pop(0).result()
+    finally:
+        shutil.rmtree(shard_dir, ignore_errors=True)
+
+def iter_pdf_elements(pdf_path, image_output_dir, temp_dir):
+    """
+    Partitions a PDF and yields its elements in document order.
+    Only pages with images, tables or charts go through hi_res layout detection;
+    plain text pages are read from the PDF's text layer with the much faster
+    "fast" strategy, and the two are merged by page number.
+    """
+    hi_res_pages, num_pages = pages_needing_hi_res(pdf_path)
+    logger.info(f"{len(hi_res_pages)} of {num_pages} pages need hi_res partitioning.")
+    if not hi_res_pages:
+        yield from partition_fast(pdf_path)
+        return
+    hi_res_elements = iter_hi_res_elements(pdf_path, hi_res_pages, num_pages, image_output_dir, temp_dir)
+    if len(hi_res_pages) == num_pages:
+        yield from hi_res_elements
+        return
+    # Every page comes from exactly one of the two streams, so the merge keeps each page's element order
+    fast_elements = partition_fast(pdf_path, skip_pages=frozenset(hi_res_pages))
+    yield from heapq.merge(fast_elements, hi_res_elements, key=element_page_number)
+
+# Element class -> how partition_and_chunk handles it: "title", "text", "image" or "table".
+# Keyed by concrete class so the loop dispatches with one dict probe instead of isinstance chains;
+# other classes are resolved on first sight by element_kind and cached here.
+_ELEMENT_KINDS = {
+    Title: "title",
+    Header: "title",
+    NarrativeText: "text",
+    ListItem: "text",
+    Text: "text",
+    Image: "image",
+    Table: "table",
+}
+
+def element_kind(element_type):
+    """
+    Returns how elements of the given class are chunked, or None for any other element.
+    Subclasses resolve like their base class, with Image and Table checked before
+    Text since unstructured derives them from it.
+    """
+    try:
+        return _ELEMENT_KINDS[element_type]
+    except KeyError:
+        pass
+    if issubclass(element_type, (Title, Header)):
+        kind = "title"
+    elif issubclass(element_type, Image):
+        kind = "image"
+    elif issubclass(element_type, Table):
+        kind = "table"
+    elif issubclass(element_type, Text):
+        kind = "text"
+    else:
+        kind = None
+    _ELEMENT_KINDS[element_type] = kind
+    return kind
+
+def text_block_document(title, text_block, metadata):
+    """Builds the Document for a section: its title followed by its text elements."""
+    text = "\n".join(text_block).strip()
+    return Document(page_content=f"{title}\n\n{text}", metadata=metadata)
+
+def partition_and_chunk(pdf_path, use_enhanced_processing=False, openai_api_key=None, temp_dir="temp_data"):
+    """
+    Partitions a PDF and intelligently chunks the content based on titles and sections.
+    This creates more contextually relevant chunks for better retrieval.
+    """
+    if use_enhanced_processing and not openai_api_key:
+        raise ValueError("OpenAI API key is required for enhanced processing.")
+
+    # Every job extracts images into its own directory: unstructured names the files after
+    # their page (figure-<page>-<n>.jpg), so concurrent jobs would overwrite each other's.
+    # The directory is removed once the summaries, which read the images, are done.
+    os.makedirs(temp_dir, exist_ok=True)
+    image_output_dir = tempfile.mkdtemp(prefix="images_", dir=temp_dir)
+    try:
+        return _chunk_pdf(pdf_path, use_enhanced_processing, openai_api_key, image_output_dir, temp_dir)
+    finally:
+        shutil.rmtree(image_output_dir, ignore_errors=True)
+
+def _chunk_pdf(pdf_path, use_enhanced_processing, openai_api_key, image_output_dir, temp_dir):
+    """Body of partition_and_chunk; extracted images are written to and read from image_output_dir."""
     documents = []
+    # Images and tables to summarize: (index of their placeholder document, kind, payload, key).
+    # Jobs sharing a key (the same image bytes or table HTML) are summarized only once.
+    summary_jobs = []
+    # Characters of text extracted so far on each page
+    page_text_chars = defaultdict(int)
     current_title = ""
-    current_text_block = ""
+    current_text_block = [] # Text of the current section, one entry per element
 
-    for i, el in enumerate(raw_pdf_elements):
-        metadata = {"source": os.path.basename(pdf_path), "page_number": el.metadata.page_number or 1, "element_id": i}
+    for i, el in enumerate(iter_pdf_elements(pdf_path, image_output_dir, temp_dir)):
+        metadata = {"source": os.path.basename(pdf_path), "page_number": element_page_number(el), "element_id": i}
 
-        if isinstance(el, (Title, Header)):
+        kind = element_kind(type(el))
+        # Images, and tables with a recovered structure, are summarized with enhanced processing;
+        # otherwise their extracted text is kept like any other text element
+        summarize = use_enhanced_processing and (kind == "image" or (kind == "table" and el.metadata.text_as_html))
+        if kind == "title":
             # When a new title/header is found, save the previous text block as a document
             if current_text_block:
-                documents.append(Document(page_content=f"{current_title}\n\n{current_text_block.strip()}", metadata=metadata))
+                documents.append(text_block_document(current_title, current_text_block, metadata))
             
             # Start a new block
             current_title = el.text
-            current_text_block = ""
+            current_text_block = []
 
-        elif isinstance(el, (NarrativeText, ListItem, Text)):
-            current_text_block += el.text + "\n"
-        
-        elif use_enhanced_processing:
+        elif summarize:
             # If we encounter an image or table, flush the current text block first
             if current_text_block:
-                documents.append(Document(page_content=f"{current_title}\n\n{current_text_block.strip()}", metadata=metadata))
-                current_text_block = ""
+                documents.append(text_block_document(current_title, current_text_block, metadata))
+                current_text_block = []
             
-            # Then process the image or table
-            if isinstance(el, Image):
-                try:
-                    image_path = el.metadata.image_path
-                    encoded_image = encode_image(image_path)
-                    summary = summarize_image(encoded_image, openai_api_key)
-                    documents.append(Document(page_content=f"[Image under '{current_title}']\nSummary: {summary}", metadata=metadata))
-                except Exception:
-                    documents.append(Document(page_content=f"[Image under '{current_title}']", metadata=metadata))
+            # Then add a placeholder for the image or table; summaries are filled in below
+            if kind == "image":
+                documents.append(Document(page_content=f"[Image under '{current_title}']", metadata=metadata))
+                # A scan of a page whose text OCR already captured adds nothing worth a vision call
+                if is_full_page(el) and page_text_chars[metadata["page_number"]] > MIN_PAGE_TEXT_CHARS:
+                    continue
+                image_path = el.metadata.image_path
+                key = ("image", image_key(image_path) or image_path)
+                summary_jobs.append((len(documents) - 1, "image", image_path, key))
             
-            elif isinstance(el, Table) and el.metadata.text_as_html:
-                try:
-                    summary = summarize_table(el.metadata.text_as_html, openai_api_key)
-                    documents.append(Document(page_content=f"[Table under '{current_title}']\nSummary: {summary}", metadata=metadata))
-                except Exception:
-                    documents.append(Document(page_content=f"[Table under '{current_title}']", metadata=metadata))
+            else:
+                documents.append(Document(page_content=f"[Table under '{current_title}']", metadata=metadata))
+                table_html = el.metadata.text_as_html
+                summary_jobs.append((len(documents) - 1, "table", table_html, ("table", table_key(table_html))))
+
+        elif kind is not None:
+            current_text_block.append(el.text)
+            page_text_chars[metadata["page_number"]] += len(el.text)
 
     # Add the last processed text block
     if current_text_block:
-        documents.append(Document(page_content=f"{current_title}\n\n{current_text_block.strip()}", metadata=metadata))
+        documents.append(text_block_document(current_title, current_text_block, metadata))
 
-    return documents
\ No newline at end of file
+    # Summarize all distinct images and tables concurrently; failed ones keep their bare placeholder
+    if summary_jobs:
+        unique_jobs = {}
+        for _, kind, payload, key in summary_jobs:
+            unique_jobs.setdefault(key, (kind, payload))
+        logger.info(f"Summarizing {len(unique_jobs)} distinct images/tables ({len(summary_jobs)} in total)...")
+        results = asyncio.run(summarize_all(list(unique_jobs.values()), openai_api_key))
+        summaries = dict(zip(unique_jobs, results))
+        for doc_index, _, _, key in summary_jobs:
+            summary = summaries[key]
+            if not isinstance(summary, Exception):
+                documents[doc_index].page_content += f"\nSummary: {summary}"
+
+    return documents
+
+@lru_cache(maxsize=1)
+def init_gpu():
+    """
+    Selects the GPU for the local layout/table models, once per worker process.
+    torch is imported here so processes that never run a model do not pay for it.
+    """
+    try:
+        import torch
+        if torch.version.cuda is None:
+            logger.warning("Installed PyTorch is a CPU-only build; local models will never use a GPU.")
+        if torch.cuda.is_available():
+            torch.cuda.set_device(0)
+            # Allow TF32 matmuls and let cuDNN pick the fastest kernels for the
+            # local layout/table models used during hi_res partitioning
+            torch.set_float32_matmul_precision("high")
+            torch.backends.cudnn.benchmark = True
+            logger.info("CUDA is available. Set default device to GPU 0.")
+        else:
+            logger.info("CUDA not available. Operations will run on CPU.")
+    except Exception as e:
+        logger.error(f"Error during GPU selection: {e}")
+
+def init_shard_worker(log_queue):
+    """Initializes a shard partitioning process: logs go to log_queue and the GPU is selected."""
+    configure_worker_logging(log_queue)
+    init_gpu()
+
+def partition_and_chunk_in_worker(log_queue, **kwargs):
+    """
+    Entry point for running partition_and_chunk in a worker process.
+    The worker's log records are sent to log_queue so the app can display them.
+    """
+    configure_worker_logging(log_queue)
+    init_gpu()
+    return partition_and_chunk(**kwargs)
@@ -1,31 +1,288 @@
+import asyncio
+import hashlib
+import heapq
 import logging
+import os
+import re
+import threading
+import weakref
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import Any, List, Optional
+import bm25s
+from bm25s.stopwords import STOPWORDS_EN
+import chromadb
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.retrievers import BaseRetriever
 from langchain_community.vectorstores import Chroma
-from langchain_community.retrievers import BM25Retriever
 from langchain.retrievers import EnsembleRetriever
 from langchain_openai import OpenAIEmbeddings
+from langchain.embeddings import CacheBackedEmbeddings
+from langchain.storage import LocalFileStore
 
 logger = logging.getLogger(__name__)
 
-def create_retriever(documents, openai_api_key, k=5):
+# Number of chunks sent per embeddings request (OpenAI accepts up to 2048 inputs)
+EMBED_BATCH_SIZE = 1000
+
+EMBEDDING_MODEL = "text-embedding-3-large"
+# Matryoshka-truncated vector size (the model's full size is 3072)
+EMBEDDING_DIMENSIONS = 1024
+# Identifies the embedding configuration in cache keys and collection names
+EMBEDDING_NAMESPACE = f"{EMBEDDING_MODEL}-{EMBEDDING_DIMENSIONS}"
+# On-disk cache of chunk embeddings, so re-indexing identical text skips the API
+EMBEDDING_CACHE_DIR = ".emb_cache"
+# Least recently used embeddings are deleted once the cache grows beyond this size
+EMBEDDING_CACHE_MAX_BYTES = 1024 * 1024 * 1024
+
+# Number of recent query embeddings kept in memory per retriever
+QUERY_CACHE_SIZE = 1024
+
+# On-disk Chroma database; each distinct set of chunks gets its own HNSW collection
+CHROMA_DIR = ".chroma"
+CHROMA_COLLECTION_METADATA = {"hnsw:space": "cosine", "hnsw:M": 32, "hnsw:construction_ef": 200}
+# Collections no live retriever uses are deleted once there are more than this many
+MAX_CHROMA_COLLECTIONS = 32
+
+# Number of live Chroma stores in this process on each collection. Reentrant because a
+# store's finalizer may run during garbage collection while this thread holds the lock.
+_collection_refs = Counter()
+_collection_lock = threading.RLock()
+
+class QueryCachedEmbeddings(Embeddings):
+    """
+    Wraps an Embeddings instance and keeps the vectors of recent queries in an
+    in-process LRU cache, so a repeated question skips the embeddings API call.
+    Queries are lowercased and whitespace-normalized before lookup.
+    """
+    def __init__(self, embeddings, maxsize=QUERY_CACHE_SIZE):
+        self.embeddings = embeddings
+        self._cached_query = lru_cache(maxsize=maxsize)(self._embed_normalized_query)
+
+    def _embed_normalized_query(self, text):
+        return tuple(self.embeddings.embed_query(text))
+
+    def embed_query(self, text):
+        return list(self._cached_query(" ".join(text.lower().split())))
+
+    def embed_documents(self, texts):
+        return self.embeddings.embed_documents(texts)
+
+    async def aembed_documents(self, texts):
+        return await self.embeddings.aembed_documents(texts)
+
+@lru_cache(maxsize=1)
+def get_chroma_client():
+    """Returns the process-wide persistent Chroma client."""
+    return chromadb.PersistentClient(path=CHROMA_DIR)
+
+def _collection_names():
+    """Names of the collections this app created in the Chroma database."""
+    # chromadb returns collection objects before 0.6 and plain names since
+    names = (c if isinstance(c, str) else c.name for c in get_chroma_client().list_collections())
+    return [name for name in names if name.startswith("rag_")]
+
+def _prune_collections():
+    """
+    Deletes collections no retriever in this process uses, once the database holds more
+    than MAX_CHROMA_COLLECTIONS. A collection stays in use for as long as any cached chain
+    or chatting session still holds a retriever built on it.
+    """
+    names = _collection_names()
+    unused = [name for name in names if not _collection_refs[name]]
+    for name in unused[:max(len(names) - MAX_CHROMA_COLLECTIONS, 0)]:
+        logger.info(f"Deleting unused Chroma collection '{name}'.")
+        get_chroma_client().delete_collection(name)
+
+def _release_collection(collection_name):
+    """Drops one reference to a collection; called when a Chroma store on it is garbage collected."""
+    with _collection_lock:
+        _collection_refs[collection_name] -= 1
+        if _collection_refs[collection_name] <= 0:
+            del _collection_refs[collection_name]
+
+def prune_embedding_cache(max_bytes=EMBEDDING_CACHE_MAX_BYTES):
+    """Deletes the least recently used cached embeddings once the cache exceeds max_bytes."""
+    entries = []
+    total = 0
+    for root, _, files in os.walk(EMBEDDING_CACHE_DIR):
+        for name in files:
+            path = os.path.join(root, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_atime, stat.st_size, path))
+            total += stat.st_size
+    if total <= max_bytes:
+        return
+
+    entries.sort()
+    removed = 0
+    for _, size, path in entries:
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+        removed += 1
+    logger.info(f"Deleted {removed} least recently used embeddings from the cache.")
+
+async def aembed_in_batches(embedding_function, texts, batch_size):
+    """Embeds texts with one request per batch of batch_size, all batches in flight at once."""
+    batches = [texts[i:i + batch_size] for i in range(0, len(texts), batch_size)]
+    results = await asyncio.gather(*(embedding_function.aembed_documents(batch) for batch in batches))
+    return [vector for batch in results for vector in batch]
+
+def build_vectorstore(documents, embedding_function, embed_batch_size=EMBED_BATCH_SIZE):
+    """
+    Returns a persistent Chroma store holding the given documents.
+    Chunks are stored under the hash of their text, in a collection named after
+    the hash of all chunk ids, so indexing a corpus that was indexed before
+    only loads it from disk instead of embedding it again.
+    New chunks are embedded with concurrent batched requests before being added.
+    """
+    unique_documents = {}
+    for doc in documents:
+        unique_documents.setdefault(hashlib.sha1(doc.page_content.encode("utf-8")).hexdigest(), doc)
+    ids = sorted(unique_documents)
+    collection_key = EMBEDDING_NAMESPACE + "".join(ids)
+    collection_name = "rag_" + hashlib.sha256(collection_key.encode("utf-8")).hexdigest()[:32]
+
+    with _collection_lock:
+        _collection_refs[collection_name] += 1
+        _prune_collections()
+        collection = get_chroma_client().get_or_create_collection(collection_name, metadata=CHROMA_COLLECTION_METADATA)
+    vectorstore = Chroma(
+        client=get_chroma_client(),
+        collection_name=collection_name,
+        embedding_function=embedding_function,
+        collection_metadata=CHROMA_COLLECTION_METADATA,
+    )
+    # The collection is protected from pruning until this store is garbage collected
+    weakref.finalize(vectorstore, _release_collection, collection_name)
+
+    existing_ids = set(collection.get(ids=ids, include=[])["ids"])
+    new_ids = [doc_id for doc_id in ids if doc_id not in existing_ids]
+    if new_ids:
+        logger.info(f"Indexing {len(new_ids)} new chunks in Chroma collection '{collection_name}'...")
+        new_documents = [unique_documents[doc_id] for doc_id in new_ids]
+        texts = [doc.page_content for doc in new_documents]
+        embeddings = asyncio.run(aembed_in_batches(embedding_function, texts, embed_batch_size))
+        # Chroma rejects writes larger than its maximum batch size (about 5.4k entries on SQLite)
+        add_batch_size = get_chroma_client().get_max_batch_size()
+        for start in range(0, len(new_ids), add_batch_size):
+            end = start + add_batch_size
+            collection.add(
+                ids=new_ids[start:end],
+                embeddings=embeddings[start:end],
+                documents=texts[start:end],
+                metadatas=[doc.metadata for doc in new_documents[start:end]],
+            )
+        prune_embedding_cache()
+    else:
+        logger.info(f"Reusing existing Chroma collection '{collection_name}'.")
+
+    return vectorstore
+
+_TOKEN_RE = re.compile(r"\w+")
+_STOPWORDS = frozenset(STOPWORDS_EN)
+
+def tokenize(text):
+    """Lowercased word tokens without English stopwords; used for both chunks and queries."""
+    return [token for token in _TOKEN_RE.findall(text.lower()) if token not in _STOPWORDS]
+
+class BM25SRetriever(BaseRetriever):
+    """
+    Keyword retriever backed by bm25s (Okapi BM25, k1=1.2, b=0.75).
+    The index is a sparse matrix and queries are scored with vectorized NumPy,
+    instead of rank_bm25's per-document Python loop.
+    """
+    docs: List[Document]
+    index: Any
+    k: int = 10
+
+    @classmethod
+    def from_documents(cls, documents, k=10):
+        index = bm25s.BM25()
+        index.index([tokenize(d.page_content) for d in documents], show_progress=False)
+        return cls(docs=list(documents), index=index, k=k)
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        results, _ = self.index.retrieve([tokenize(query)], k=min(self.k, len(self.docs)), show_progress=False)
+        return [self.docs[i] for i in results[0]]
+
+class RankFusionRetriever(EnsembleRetriever):
+    """
+    EnsembleRetriever whose weighted reciprocal rank fusion scores and
+    de-duplicates the documents in a single dictionary pass. With top_k set,
+    only the top_k best documents are selected, using a heap instead of a
+    full sort; by default all documents are returned, as in EnsembleRetriever.
+    """
+    top_k: Optional[int] = None
+
+    def weighted_reciprocal_rank(self, doc_lists: List[List[Document]]) -> List[Document]:
+        if len(doc_lists) != len(self.weights):
+            raise ValueError("Number of rank lists must be equal to the number of weights.")
+
+        # key -> [first document seen with this key, fused score]
+        fused = {}
+        for doc_list, weight in zip(doc_lists, self.weights):
+            for rank, doc in enumerate(doc_list, start=1):
+                key = doc.page_content if self.id_key is None else doc.metadata[self.id_key]
+                entry = fused.get(key)
+                if entry is None:
+                    entry = fused[key] = [doc, 0.0]
+                entry[1] += weight / (rank + self.c)
+
+        entries = fused.values()
+        if self.top_k is None:
+            ranked = sorted(entries, key=lambda entry: entry[1], reverse=True)
+        else:
+            ranked = heapq.nlargest(self.top_k, entries, key=lambda entry: entry[1])
+        return [doc for doc, _ in ranked]
+
+def create_retriever(documents, openai_api_key, k=5, embed_batch_size=EMBED_BATCH_SIZE):
     if not documents:
         logger.warning("No documents provided to create_retriever. Returning None.")
         return None
 
     logger.info(f"Creating retriever for {len(documents)} documents...")
     
-    logger.info("Initializing OpenAI embeddings...")
-    embedding_function = OpenAIEmbeddings(model = "text-embedding-3-large",api_key=openai_api_key)
+    logger.info(f"Initializing OpenAI embeddings with batch size {embed_batch_size}...")
+    underlying_embeddings = OpenAIEmbeddings(
+        model=EMBEDDING_MODEL,
+        dimensions=EMBEDDING_DIMENSIONS,
+        api_key=openai_api_key,
+        chunk_size=embed_batch_size,
+    )
+    # Keys are SHA-256 of the text under a per-configuration namespace, so a model change never collides
+    embedding_function = QueryCachedEmbeddings(CacheBackedEmbeddings.from_bytes_store(
+        underlying_embeddings,
+        # Reads refresh access times, which prune_embedding_cache uses to find stale entries
+        LocalFileStore(EMBEDDING_CACHE_DIR, update_atime=True),
+        namespace=EMBEDDING_NAMESPACE,
+        key_encoder="sha256",
+    ))
 
-    logger.info("Creating Chroma vector store for dense retrieval...")
-    vectorstore = Chroma.from_documents(documents, embedding_function)
+    # The two indexes are independent: Chroma waits on the embeddings API while
+    # BM25 tokenizes on the CPU, so they are built at the same time
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        logger.info("Creating Chroma vector store for dense retrieval...")
+        vectorstore_future = executor.submit(build_vectorstore, documents, embedding_function, embed_batch_size)
+        logger.info("Creating BM25 retriever for keyword retrieval...")
+        bm25_future = executor.submit(BM25SRetriever.from_documents, documents, k=10)
+        vectorstore = vectorstore_future.result()
+        bm25_retriever = bm25_future.result()
     dense_retriever = vectorstore.as_retriever(search_kwargs={"k": 10})
 
-    logger.info("Creating BM25 retriever for keyword retrieval...")
-    bm25_retriever = BM25Retriever.from_documents(documents)
-    bm25_retriever.k = 10
-
     logger.info("Creating ensemble retriever with weights [0.7 dense, 0.3 keyword]...")
-    ensemble_retriever = EnsembleRetriever(
+    ensemble_retriever = RankFusionRetriever(
         retrievers=[dense_retriever, bm25_retriever],
         weights=[0.7, 0.3]
     )